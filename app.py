@@ -2,348 +2,140 @@ import os
 import io
 import base64
 import json
-import traceback
 import re
 import sys
 import subprocess
 import tempfile
+import shutil
+import uuid
+import hashlib
+import codecs
 import asyncio
 import signal
+import logging
+import logging.handlers
+import queue
+import atexit
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 from functools import wraps
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
-from typing import List, Any, Dict, Optional
+from typing import List, Any, Dict, Optional, Tuple
 from dotenv import load_dotenv
 import anthropic
+import orjson
+import diskcache
+import aiofiles
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 # --- Configuration ---
 load_dotenv()
+
+# Logging: the request path only enqueues records, a listener thread formats and writes them.
+# DEBUG also shows generated scripts, captured output and uploaded questions.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+logger = logging.getLogger("data_analyst_agent")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Registered first, so it runs last and flushes every cleanup message
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 if not ANTHROPIC_API_KEY:
     raise RuntimeError("ANTHROPIC_API_KEY not found in .env file")
 
-# Configure Claude
-claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Configure Claude: one HTTP/2 connection pool shared by every call, so concurrent requests
+# multiplex over a few warm TLS connections instead of opening new ones. The SDK's own client
+# factory matches whichever HTTP library the installed SDK is built on; in-flight calls are
+# already capped by MAX_CONCURRENT_CLAUDE_CALLS, so its default connection limits apply.
+claude_http_client = anthropic.DefaultAsyncHttpxClient(
+    http2=True,
+    timeout=anthropic.Timeout(600.0, connect=10.0)  # Long non-streamed image responses need the SDK's 10 minutes
+)
+claude_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=claude_http_client)
 
 # Constants
 MAX_DEBUG_RETRIES = 3
+FAST_CODER_MODEL = "claude-3-5-haiku-20241022"  # Writes the first plan and script; debug retries use Sonnet
+ESCALATION_CACHE_SIZE = 1024  # Questions remembered as needing Sonnet from the first attempt
+# Draft the next fix while a script runs: a debugger call per attempt, even successful ones
+SPECULATIVE_DEBUG_RETRIES = os.getenv("SPECULATIVE_DEBUG_RETRIES", "false").lower() in ("1", "true", "yes")
 MAX_ACQUISITION_RETRIES = 1  # New constant for data acquisition retries
 DOCKER_EXECUTION_TIMEOUT = 180 # 3 minutes as requested
 DOCKER_IMAGE_NAME = "analyst-sandbox"
+MAX_CONCURRENT_CLAUDE_CALLS = 8  # Cap on in-flight Claude requests across all pipelines, for rate limits
+BLOCKING_IO_THREADS = 16  # Default executor size: file writes, hashing and container start/stop per worker
+SANDBOX_POOL_MIN_SIZE = 2  # Containers started and kept warm at server startup
+SANDBOX_POOL_MAX_SIZE = 4  # Upper bound on concurrently running sandbox containers
+# "keep_alive": containers are reused across executions. "per_run": each container runs a single
+# script and is then replaced by a fresh one started in the background.
+CONTAINER_REUSE_STRATEGY = os.getenv("CONTAINER_REUSE_STRATEGY", "keep_alive")
 MAX_PIPELINE_TIMEOUT = 300  # 5 minutes total timeout for entire pipeline
-
-# --- 1. Secure Code Execution using Docker Sandbox ---
-DOCKER_CONTAINER_NAME = "analyst-sandbox-running"
-
-def ensure_docker_container_running(data_dir):
-    """Ensure the persistent Docker container is running with /data mounted."""
-    result = subprocess.run(
-        ["docker", "ps", "-a", "--filter", f"name={DOCKER_CONTAINER_NAME}", "--format", "{{.Status}}"],
-        capture_output=True, text=True
-    )
-    status = result.stdout.strip().lower()
-
-    if not status:
-        print(f"🚀 Starting persistent container '{DOCKER_CONTAINER_NAME}'...")
-        subprocess.run([
-            "docker", "run", "-dit",
-            "--name", DOCKER_CONTAINER_NAME,
-            "-v", f"{data_dir}:/data",  # mount host data_dir
-            DOCKER_IMAGE_NAME, "bash"
-        ], check=True)
-    elif not status.startswith("up"):
-        print(f"🔄 Starting stopped container '{DOCKER_CONTAINER_NAME}'...")
-        subprocess.run(["docker", "start", DOCKER_CONTAINER_NAME], check=True)
-    else:
-        print(f"✅ Container '{DOCKER_CONTAINER_NAME}' is already running.")
-
-def execute_python_code_docker(code: str, data_dir: str) -> dict:
-    """Executes Python code in an isolated Docker container with a fresh mount each time."""
-    # Use the timeout-enabled version with default timeout
-    return execute_python_code_docker_with_timeout(code, data_dir, DOCKER_EXECUTION_TIMEOUT)
-
-# --- Helper function to run pipeline with timeout ---
-async def run_with_timeout(coro, timeout_seconds: int, fallback_question: str):
-    """Run a coroutine with a timeout and return fallback response if timeout occurs."""
-    try:
-        return await asyncio.wait_for(coro, timeout=timeout_seconds)
-    except asyncio.TimeoutError:
-        print(f"⏰ Pipeline timed out after {timeout_seconds} seconds")
-        print("🔄 Generating fallback response due to timeout...")
-        fallback_response = generate_fallback_response(fallback_question)
-        print(f"✅ Timeout fallback response generated: {fallback_response}")
-        return fallback_response
-    except Exception as e:
-        print(f"❌ Unexpected error in timeout wrapper: {str(e)}")
-        fallback_response = generate_fallback_response(fallback_question)
-        return fallback_response
-
-# --- Helper function to execute with timeout ---
-def execute_python_code_docker_with_timeout(code: str, data_dir: str, timeout: int = DOCKER_EXECUTION_TIMEOUT) -> dict:
-    """Executes Python code in Docker with configurable timeout."""
-    print("\n" + "="*60)
-    print("🐍 EXECUTING GENERATED CODE IN A DOCKER SANDBOX 🐍")
-    print(f"⏰ Timeout set to {timeout} seconds")
-    print("-" * 60)
-
-    script_filename = ""
-    try:
-        # Write the Python code to a file in data_dir
-        with tempfile.NamedTemporaryFile(mode='w+', dir=data_dir, delete=False, suffix='.py', encoding='utf-8') as tmp_file:
-            tmp_file.write(code)
-            script_filename = os.path.basename(tmp_file.name)
-
-        # Run container with data_dir mounted as /data
-        docker_command = [
-            "docker", "run", "--rm",
-            "-v", f"{data_dir}:/data",
-            DOCKER_IMAGE_NAME,
-            "python", f"/data/{script_filename}"
-        ]
-        print(f"--- Executing Docker command: {' '.join(docker_command)} ---")
-
-        process = subprocess.run(
-            docker_command,
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
-
-        if process.returncode == 0:
-            output = process.stdout.strip()
-            print("✅ Docker execution SUCCESSFUL.")
-            if not output:
-                print("⚠️ WARNING: Script ran successfully but produced NO output.")
-                return {
-                    "output": None,
-                    "error": "Script ran without errors but produced no output. The final print() statement is likely missing."
-                }
-
-            try:
-                parsed_output = json.loads(output)
-                if isinstance(parsed_output, dict) and "error" in parsed_output:
-                    print(f"❌ Docker execution FAILED. Script returned a JSON error.")
-                    print(f">>> CAPTURED ERROR:\n{parsed_output['error']}")
-                    return {"output": None, "error": parsed_output['error']}
-            except json.JSONDecodeError:
-                pass
-
-            print(f">>> CAPTURED OUTPUT (Truncated):\n{output[:1000]}...")
-            return {"output": output, "error": None}
-        else:
-            error_output = process.stderr.strip()
-            print(f"❌ Docker execution FAILED.")
-            print(f">>> CAPTURED ERROR:\n{error_output}")
-            return {"output": None, "error": error_output}
-
-    except subprocess.TimeoutExpired:
-        print(f"⏰ Docker command timed out after {timeout} seconds")
-        return {"output": None, "error": f"Docker command timed out after {timeout} seconds"}
-    except Exception as e:
-        print(f"❌ Docker launch ERROR: {e}")
-        if "No such file or directory" in str(e) or "not found" in str(e):
-            return {
-                "output": None,
-                "error": f"Docker command failed. Is Docker installed and running? Have you built the '{DOCKER_IMAGE_NAME}' image?"
-            }
-        return {"output": None, "error": str(e)}
-def generate_fallback_response(question: str) -> str:
-    """Generate a fallback JSON response when analysis fails."""
-    print("\n--- Generating Fallback Response ---")
-    
-    fallback_prompt = f"""
-You are tasked with generating a valid JSON response structure based on the user's question/request, even though the actual analysis failed.
-
-**Instructions:**
-1. Analyze the user's request to understand what format they expect in the response
-2. Generate a JSON response in the exact format they would expect if the analysis had succeeded
-3. For data values, use placeholder values like "N/A", "Error: Data not available", null, or empty arrays/objects as appropriate
-4. Maintain the exact structure they would expect but indicate that data is not available
-5. Do not explain the failure - just provide the expected JSON structure with placeholder values
-
-**User Request:**
-{question}
-
-**Your Fallback JSON Response:**
-"""
-    
-    try:
-        fallback_response = claude_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=2000,
-            messages=[{"role": "user", "content": fallback_prompt}]
-        )
-        
-        response_text = fallback_response.content[0].text.strip()
-        
-        # Extract JSON from response
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            fallback_json = json_match.group(0)
-            # Validate it's proper JSON
-            json.loads(fallback_json)  # This will raise an exception if invalid
-            print(f"✅ Fallback JSON Response Generated")
-            return fallback_json
-        else:
-            # If no JSON found, create a basic error response
-            return json.dumps({"error": "Analysis failed", "result": "Data not available"})
-            
-    except Exception as e:
-        print(f"❌ Error generating fallback response: {e}")
-        # Last resort fallback
-        return json.dumps({"error": "Analysis failed", "result": "Data not available"})
-
-# --- 2. Helper Function to Create File Previews ---
-def create_file_previews(files: Dict[str, bytes]) -> str:
-    preview_parts = []
-    for name, content in files.items():
-        preview_parts.append(f"--- File: {name} ---")
-        try:
-            text_content = content.decode('utf-8')
-            lines = text_content.splitlines()
-            preview_parts.append("\n".join(lines[:20]))
-            if len(lines) > 20:
-                preview_parts.append("... (file truncated)")
-        except UnicodeDecodeError:
-            # Check if it's an image file
-            if name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')):
-                preview_parts.append(f"Image file, Size: {len(content)} bytes")
-            else:
-                preview_parts.append(f"Binary file, Size: {len(content)} bytes")
-        preview_parts.append("-" * (len(name) + 10))
-    return "\n".join(preview_parts)
-
-# --- 2.5. Helper Function to Process Images with LLM ---
-def process_images_with_llm(question: str, files: Dict[str, bytes]) -> Dict[str, Any]:
-    """Process images using LLM to extract relevant data based on questions."""
-    image_files = {name: content for name, content in files.items() 
-                  if name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'))}
-    
-    if not image_files:
-        return {}
-    
-    image_analysis_results = {}
-    
-    for image_name, image_content in image_files.items():
-        print(f"\n--- Processing Image: {image_name} with LLM ---")
-        
-        # Convert image bytes to base64 for LLM processing
-        import base64
-        image_base64 = base64.b64encode(image_content).decode('utf-8')
-        
-        image_analysis_prompt = f"""
-You are an expert data analyst specializing in extracting structured information from images. 
-Analyze the provided image and extract ALL relevant data that could help answer the user's questions.
-
-**User Questions/Request:**
-{question}
-
-**Your Task:**
-1. Examine the image carefully
-2. Extract ALL numerical data, text data, tables, charts, or any structured information
-3. If there are tables, extract them in a structured format (rows and columns)
-4. If there are charts/graphs, extract the data points and values
-5. If there's text, extract key information relevant to the questions
-6. Return the extracted data in a structured JSON format
-
-**Output Format:**
-Return a JSON object with the following structure:
-{{
-    "extracted_data": {{
-        "tables": [
-            {{"table_name": "table1", "headers": ["col1", "col2"], "rows": [["val1", "val2"], ...]}},
-            ...
-        ],
-        "charts": [
-            {{"chart_type": "bar/line/pie", "title": "chart_title", "data": {{"labels": [...], "values": [...]}}}},
-            ...
-        ],
-        "key_values": {{
-            "metric1": "value1",
-            "metric2": "value2",
-            ...
-        }},
-        "text_content": "Any relevant text content...",
-        "summary": "Brief summary of what was found in the image"
-    }},
-    "image_filename": "{image_name}"
-}}
-
-**Important:**
-- Extract actual values, not placeholders
-- Be precise with numbers and data
-- If you can't extract certain data, indicate "not_available"
-- Focus on data relevant to answering the user's questions
-"""
-
-        try:
-            # Determine image media type
-            image_extension = image_name.split('.')[-1].lower()
-            media_type_map = {
-                'jpg': 'image/jpeg',
-                'jpeg': 'image/jpeg',
-                'png': 'image/png',
-                'gif': 'image/gif',
-                'bmp': 'image/bmp',
-                'webp': 'image/webp'
-            }
-            media_type = media_type_map.get(image_extension, 'image/jpeg')
-            
-            response = claude_client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": image_analysis_prompt
-                            },
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": media_type,
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    }
-                ]
-            )
-            
-            response_text = response.content[0].text
-            
-            # Extract JSON from response
-            import re, json
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                image_data = json.loads(json_match.group(0))
-                image_analysis_results[image_name] = image_data
-                print(f"✅ Successfully extracted data from {image_name}")
-            else:
-                print(f"❌ Could not extract structured data from {image_name}")
-                image_analysis_results[image_name] = {"error": "Could not parse LLM response"}
-                
-        except Exception as e:
-            print(f"❌ Error processing image {image_name}: {str(e)}")
-            image_analysis_results[image_name] = {"error": str(e)}
-    
-    return image_analysis_results
-
-# --- 3. Main Analysis Pipeline ---
-async def run_analysis_pipeline(question: str, files: Dict[str, bytes], data_dir: str) -> Any:
-    """Runs the full, dynamic analysis pipeline using Claude models."""
-   
-    # --- STAGE 1: STRATEGIC PLANNING ---
-    print("\n--- STAGE 1: Calling Chief Strategist LLM ---")
-    file_previews = create_file_previews(files)
-    
-    # Check if we have images
-    has_images = any(name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')) 
-                    for name in files.keys())
-   
-    strategist_prompt = f"""
+MAX_CONCURRENT_PIPELINES = int(os.getenv("MAX_CONCURRENT_PIPELINES", "4"))  # Pipelines running at once per worker
+MAX_QUEUED_PIPELINES = int(os.getenv("MAX_QUEUED_PIPELINES", "16"))  # Waiting pipelines before new requests get a 429
+MAX_BATCH_QUESTIONS = 20  # Questions accepted in one questions.json upload
+IMAGE_TEXT_CONTENT_LIMIT = 1024  # Characters of free text kept per image in the planner prompt
+MAX_PROMPT_EMBED_BYTES = 50_000  # Cap on the serialized image data embedded in the planner prompt
+FALLBACK_MIN_LLM_SECONDS = 5  # Below this much remaining budget the fallback skips the LLM
+PIPELINE_CACHE_SIZE = 128  # Successful runs remembered by request content hash
+STRATEGY_CACHE_SIZE = 512  # Strategist decisions remembered by question + file names
+SCRIPT_CACHE_SIZE = 256  # Validated scripts remembered for repeats of the same question
+DATA_STRUCTURE_CACHE_SIZE = 128  # Captured data structures remembered by question + uploaded data content hash
+SCRIPT_CACHE_TTL = 24 * 60 * 60  # Seconds a validated script stays reusable
+FILE_PREVIEW_BYTES = 4096  # Only this much of each file is read for previews
+UPLOAD_CHUNK_BYTES = 1 << 20  # Streamed uploads are written to disk in chunks of at least this size
+REQUEST_FILENAMES = ("question.txt", "questions.json")  # Kept in memory; every other upload is a data file
+IMAGE_BATCH_MAX_BYTES = 20 * 1024 * 1024  # Cap on combined base64 image data per multimodal request
+IMAGE_OUTPUT_TOKENS = 4000  # Output budget per image in an extraction request
+IMAGE_BATCH_MAX_IMAGES = 8192 // IMAGE_OUTPUT_TOKENS  # Images per request that still get a full output budget each
+IMAGE_DATA_FILENAME = "_image_extracted.json"  # Extracted image data, staged into /data next to the uploads
+CLAUDE_CACHE_DIR = os.getenv("CLAUDE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "claude_cache"))
+CLAUDE_CACHE_TTL = 24 * 60 * 60  # Seconds a cached Claude response stays valid
+EXECUTION_CACHE_DIR = os.getenv("EXECUTION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "execution_cache"))
+EXECUTION_CACHE_TTL = 24 * 60 * 60  # Seconds a successful script output stays reusable
+
+# Uploads and sandbox workspaces share one filesystem so staging can hard-link instead of copy.
+# Disk by default: uploads can be hundreds of MB, so a tmpfs such as /dev/shm is opt-in via SCRATCH_DIR.
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", tempfile.gettempdir())
+
+# First fenced code block. The closing fence must start or end a line, so ``` inside a string
+# of the script does not end it; a missing closing fence (truncated response) runs to the end.
+# A fence with the code on the same line (```python print(1)```) is matched as `inline`.
+_CODE_FENCE_RE = re.compile(
+    r'```(?:[\w+-]*[^\S\n]*\n(?P<block>.*?)(?:\n```[^\S\n]*(?:\n|\Z)|(?<=\S)```[^\S\n]*(?:\n|\Z)|\Z)'
+    r'|(?:(?:python3?|py)[^\S\n]+)?(?P<inline>[^\n]*?)```)',
+    re.DOTALL
+)
+# Any runnable analysis script has at least one of these; a reply without them is prose, not code
+_CODE_MARKER_RE = re.compile(r'\b(?:import|def|print)\b|=')
+
+# Lines such as "1. ..." or "2) ..." that number the individual questions of a request
+_NUMBERED_QUESTION_RE = re.compile(r'^\s*\d+[.)]\s', re.MULTILINE)
+
+# Requests that explicitly ask for the answers as a JSON array
+_ARRAY_ANSWER_RE = re.compile(r'\b(json\s+array|array\s+of)\b', re.IGNORECASE)
+
+# Health-check style probes that should not start a pipeline
+_PROBE_QUESTION_RE = re.compile(r'^\s*(ping|hello|hi|test)\W*$', re.IGNORECASE)
+# Questions that analyze an upload, which are impossible when no data files arrived
+_UPLOAD_REFERENCE_RE = re.compile(r'\b(attached|uploaded)\s+(files?|csv|dataset|data|spreadsheet|images?)\b', re.IGNORECASE)
+# Questions that name a web source, whose data never comes from an upload
+_URL_RE = re.compile(r'https?://', re.IGNORECASE)
+MIN_QUESTION_LENGTH = 10  # Shorter questions cannot describe an analysis
+
+IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"})
+
+# --- Static Prompt Blocks ---
+# The instruction text below never changes between requests, so it is sent as a
+# cached `system` block and only the per-request values go in the user message.
+STRATEGIST_SYSTEM_PROMPT = """
 You are a Chief Strategist for a data analysis agent. Your job is to analyze the user's request and decide the analysis approach.
 
 **Decision Criteria:**
@@ -360,64 +152,33 @@ You are a Chief Strategist for a data analysis agent. Your job is to analyze the
 - Web scraping ALWAYS needs scouting to understand the page structure
 - Only exclude scouting for images and large enterprise data warehouses with known schemas
 
-Your output must be a single, valid JSON object with these keys:
+Record your decision by calling the `record_strategy` tool with these fields:
 - "has_images": boolean (true if image files are present)
 - "image_processing_required": boolean (true if images contain relevant data)
 - "scouting_required": boolean (TRUE for local files/web scraping/APIs, FALSE only for images and pre-configured data warehouses)
 - "data_source_type": string ("web", "database", "local_file", "images_only", or "mixed")
-
-**User Request (from questions.txt):**
-{question}
-
-**Available Data File Previews:**
-{file_previews}
-
-**Has Images:** {has_images}
-
-**Your JSON Decision:**
 """
-   
-    strategist_response = claude_client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=4000,
-        messages=[{"role": "user", "content": strategist_prompt}]
-    )
-    raw_response_text = strategist_response.content[0].text
-    json_match = re.search(r'\{.*\}', raw_response_text, re.DOTALL)
-    if not json_match:
-        raise ValueError("Strategist LLM did not return a valid JSON object.")
-    strategy_decision_text = json_match.group(0)
-    strategy = json.loads(strategy_decision_text)
-    print(f"✅ Strategy Decided: {strategy}")
 
-    # --- STAGE 1.5: IMAGE PROCESSING (if required) ---
-    image_extracted_data = {}
-    if strategy.get("image_processing_required", False):
-        print("\n--- STAGE 1.5: Processing Images with LLM ---")
-        image_extracted_data = process_images_with_llm(question, files)
-        print(f"✅ Image Data Extracted: {len(image_extracted_data)} images processed")
+# Forcing this tool makes the strategist return its decision as already-parsed structured input
+STRATEGY_TOOL = {
+    "name": "record_strategy",
+    "description": "Record the analysis strategy decided for the user's request.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "has_images": {"type": "boolean"},
+            "image_processing_required": {"type": "boolean"},
+            "scouting_required": {"type": "boolean"},
+            "data_source_type": {
+                "type": "string",
+                "enum": ["web", "database", "local_file", "images_only", "mixed"]
+            }
+        },
+        "required": ["has_images", "image_processing_required", "scouting_required", "data_source_type"]
+    }
+}
 
-    # --- STAGE 2: DATA ACQUISITION WITH ERROR HANDLING (for non-image files) ---
-    actual_data_structure = "Not available. Plan must be based on the user's provided schema."
-    if strategy.get("scouting_required", False):
-        print("\n--- STAGE 2: Generating and Executing Data Acquisition Script ---")
-        
-        # Filter out image files for traditional data acquisition
-        non_image_files = [name for name in files.keys() 
-                          if not name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'))]
-        
-        acquisition_success = False
-        acquisition_attempt = 0
-        
-        while acquisition_attempt <= MAX_ACQUISITION_RETRIES and not acquisition_success:
-            acquisition_attempt += 1
-            print(f"--- Data Acquisition Attempt {acquisition_attempt} ---")
-            
-            # Calculate remaining time for acquisition timeout
-            remaining_time = max(60, DOCKER_EXECUTION_TIMEOUT // 2)  # At least 1 minute, or half the default timeout
-            print(f"⏰ Data acquisition timeout set to {remaining_time} seconds")
-            
-            acquisition_prompt = f"""
+ACQUISITION_SYSTEM_PROMPT = """
 You are a data acquisition script generator. Based on the user's request, write a Python script to load a SMALL SAMPLE of the NON-IMAGE data and inspect its structure.
 
 **Instructions:**
@@ -428,68 +189,18 @@ You are a data acquisition script generator. Based on the user's request, write
 - For other types of files, use the most common and reliable Python libraries for that type.
 - Get all the important data preview required for solving the questions. Like the column names, unique values in the categorical columns, and at max 50 rows of data or any other important information that will be used in the code and hence we need the correct names or values of that. So that we have enough data context.
 
-**IMPORTANT:** 
+**IMPORTANT:**
 - DO NOT process image files - they are handled separately
 - Focus only on structured data files (CSV, JSON, PDF, etc.)
 - The script MUST print structured dataset previews (`print("COLUMNS:", df.columns)` and `print("HEAD:", df.head().to_json(orient='split'))`)
 
 CRITICAL - Your output must be ONLY the raw Python code inside ```python ... ``` tags, no explanation text.
-
-**Available Non-Image Files:**
-{non_image_files}
-
-**User Request (from questions.txt):**
-{question}
-
-{"**Previous Acquisition Error:** " + str(acquisition_error) if acquisition_attempt > 1 else ""}
-
-**Your Data Acquisition Script:**
-"""
-            
-            acquisition_response = claude_client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=2000,
-                messages=[{"role": "user", "content": acquisition_prompt}]
-            )
-            acquisition_code = acquisition_response.content[0].text.strip().lstrip("```python").rstrip("```")
-
-            print(acquisition_code)
-           
-            # Use timeout-enabled execution for data acquisition
-            acquisition_result = execute_python_code_docker_with_timeout(acquisition_code, data_dir, remaining_time)
-            
-            if acquisition_result["output"]:
-                actual_data_structure = acquisition_result["output"]
-                print(f"✅ Data Structure Captured:\n{actual_data_structure}")
-                acquisition_success = True
-            else:
-                acquisition_error = acquisition_result["error"]
-                print(f"❌ Data Acquisition Failed (Attempt {acquisition_attempt}): {acquisition_error}")
-                
-                if acquisition_attempt > MAX_ACQUISITION_RETRIES:
-                    print(f"⚠️ Data acquisition failed after {MAX_ACQUISITION_RETRIES + 1} attempts. Continuing without data structure context...")
-                    actual_data_structure = f"Data acquisition failed. Error: {acquisition_error}. Proceeding without detailed data structure."
-
-    # --- STAGE 3: ANALYSIS PLANNING ---
-    print("\n--- STAGE 3: Calling Analysis Planner with Full Context ---")
-    
-    # Prepare image data context for the planner
-    image_data_context = ""
-    if image_extracted_data:
-        image_data_context = f"""
-**EXTRACTED IMAGE DATA:**
-The following data has been extracted from images using LLM analysis:
-{json.dumps(image_extracted_data, indent=2)}
-
-**Important:** This image data is already extracted and available as Python variables. DO NOT attempt to reprocess images.
 """
 
-    analysis_planner_prompt = f"""
-You are a **professional data scientist** tasked with creating a **final, detailed, and EFFICIENT execution plan**. 
+ANALYSIS_PLANNER_SYSTEM_PROMPT = """
+You are a **professional data scientist** tasked with creating a **final, detailed, and EFFICIENT execution plan**.
 You have been provided with the user's request and the exact structure of available data (both traditional data and image-extracted data).
 
-{image_data_context}
-
 Follow the instructions below **exactly**. The goal is to generate a Python plan that works on any dataset, cleans data correctly, and produces the requested outputs without errors.
 
 ---
@@ -593,43 +304,10 @@ When generating the plan:
 
 ---
 
-**User Request (from questions.txt):**
-{question}
-
-**ACTUAL Data Structure (traditional data, if available):**
-{actual_data_structure}
-
-**CRITICAL: You MUST use the EXACT column names, data types, and values shown in the ACTUAL Data Structure above. Do not assume or guess - use only what is explicitly shown in the preview data.**
-
-**Your Final, EFFICIENT Execution Plan:**
+**CRITICAL: You MUST use the EXACT column names, data types, and values shown in the ACTUAL Data Structure provided by the user. Do not assume or guess - use only what is explicitly shown in the preview data.**
 """
 
-    final_plan_response = claude_client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=4000,
-        messages=[{"role": "user", "content": analysis_planner_prompt}]
-    )
-    execution_plan = final_plan_response.content[0].text
-    print(f"✅ Final Execution Plan Generated:\n{execution_plan}")
-
-    # --- STAGE 4: FINAL EXECUTION & DEBUGGING WITH FALLBACK ---
-    print("\n--- STAGE 4: Calling Coder LLM to Generate Final Script ---")
-   
-    generated_code = ""
-    last_error = ""
-    
-    try:
-        for attempt in range(MAX_DEBUG_RETRIES):
-            print(f"--- Attempt {attempt + 1} of {MAX_DEBUG_RETRIES} ---")
-            
-            # Calculate remaining timeout for each attempt - progressively shorter
-            base_timeout = DOCKER_EXECUTION_TIMEOUT
-            attempt_timeout = max(60, base_timeout - (attempt * 30))  # Reduce timeout by 30s each attempt, minimum 60s
-            print(f"⏰ Execution timeout for attempt {attempt + 1}: {attempt_timeout} seconds")
-           
-            coder_prompt = ""
-            if attempt == 0:
-                coder_prompt = f"""
+CODER_SYSTEM_PROMPT = """
 You are an expert Python programmer. Write a single, self-contained Python script to strictly follow the provided execution plan.
 **CRITICAL RULES:**
 1.  Your output MUST be ONLY the raw Python code inside ```python ... ``` tags. Do not include explanations.
@@ -637,7 +315,7 @@ You are an expert Python programmer. Write a single, self-contained Python scrip
 3.  When reading local files, you MUST use the absolute path `/data/filename.csv`. For example: `pd.read_csv('/data/sample-sales.csv')`.
 4.  The script's final output must be printed to standard output in the exact format requested by the user's original question (e.g., a JSON object or array), containing ONLY the answers, not the questions.
 5.  **Your response must contain ONLY Python code, no explanations**
-6.  **DO NOT start with "Here's a script" or any explanatory text** 
+6.  **DO NOT start with "Here's a script" or any explanatory text**
 7.  **While cleaning the data do not assume NaN if the data is not cleaned and have some characters other than the expected data type.**
 8.  **CRITICAL: Use ONLY the exact column names, values, and data types shown in the ACTUAL Data Structure. Do not assume or guess country codes, column names, or data formats.**
 
@@ -645,175 +323,1565 @@ You are an expert Python programmer. Write a single, self-contained Python scrip
 - Image data has been pre-processed and is available in the `image_extracted_data` variable
 - DO NOT import image processing libraries or attempt to process images
 - Access image data like: `image_extracted_data['image_name']['extracted_data']`
-- The image_extracted_data structure is:
-{json.dumps(image_extracted_data, indent=2) if image_extracted_data else "No image data available"}
+"""
 
-**Final Execution Plan to Follow:**
-{execution_plan}
+# Planning and the first script are produced by one call; this closes the combined system prompt
+PLAN_AND_CODE_OUTPUT_RULES = """
+---
 
-**Your Final Python Script:**
+## OUTPUT FORMAT FOR THIS RESPONSE
+You are writing BOTH the execution plan and the Python script that follows it, in a single response. This overrides any earlier instruction to output only one of them:
+1. First write the complete execution plan inside <plan>...</plan> tags.
+2. Then write the complete Python script that implements the plan inside <code>```python ... ```</code> tags.
+Write nothing outside these two sections.
 """
-            else:
-                print("--- Code failed. Calling LLM in Debug Mode. ---")
-                coder_prompt = f"""
+
+PLAN_AND_CODE_SYSTEM_PROMPT = ANALYSIS_PLANNER_SYSTEM_PROMPT + CODER_SYSTEM_PROMPT + PLAN_AND_CODE_OUTPUT_RULES
+
+DEBUGGER_SYSTEM_PROMPT = """
 You are an expert Python debugger. The previous attempt failed. Analyze the original user request, the execution plan, the faulty code, and the error message. Then, provide a corrected, complete Python script.
 Think step-by-step about what went wrong and how to fix it, then provide the full, corrected code inside ```python ... ``` tags.
 1.  **Your response must contain ONLY Python code, no explanations**
-2.  **DO NOT start with "Here's a script" or any explanatory text** 
+2.  **DO NOT start with "Here's a script" or any explanatory text**
 3.  **While cleaning the data do not assume NaN if the data is not cleaned and have some characters other than the expected data type.**
 4.  ** DO NOT TRY TO DOWNLOAD THE DATA FROM A DATABASE IF THE DATA IS VERY LARGE**
 5.  **CRITICAL: Use ONLY the exact column names, values, and data types from the ACTUAL Data Structure. Pay special attention to country codes, date formats, and column names shown in the preview data.**
 **CRITICAL RULE FOR FILE PATHS:** If the error is a `FileNotFoundError`, it is because the script is not using the correct absolute path. All data files are in the `/data/` directory inside the Docker container. You MUST correct the code to read files from this path (e.g., `pd.read_csv('/data/sample-sales.csv')`).
 
-**ACTUAL Data Structure Available:**
-{actual_data_structure}
+**IMPORTANT: The ACTUAL Data Structure provided by the user shows the EXACT format of the data. Use the exact country codes, column names, and data types shown. Do not assume different formats.**
+"""
+
+# --- Per-Request Prompt Templates ---
+# Only the small dynamic fields are substituted into these on each call.
+STRATEGIST_USER_TEMPLATE = Template("""
+**User Request (from questions.txt):**
+$question
+
+**Available Data File Previews:**
+$file_previews
 
-**IMPORTANT: The above data structure shows the EXACT format of the data. Use the exact country codes, column names, and data types shown. Do not assume different formats.**
+**Has Images:** $has_images
+
+**Record Your Decision:**
+""")
+
+ACQUISITION_USER_TEMPLATE = Template("""
+**Available Non-Image Files:**
+$non_image_files
+
+**User Request (from questions.txt):**
+$question
+
+$previous_error
+
+**Your Data Acquisition Script:**
+""")
+
+PLAN_AND_CODE_USER_TEMPLATE = Template("""
+$image_data_context
+
+**User Request (from questions.txt):**
+$question
+
+**ACTUAL Data Structure (traditional data, if available):**
+$actual_data_structure
+
+**Your Final, EFFICIENT Execution Plan and Python Script:**
+""")
+
+# Identical for every debug retry of a request, so it is sent as a second cached system block
+DEBUGGER_CONTEXT_TEMPLATE = Template("""
+**ACTUAL Data Structure Available:**
+$actual_data_structure
 
 **Original User Request (from questions.txt):**
-{question}
+$question
 
 **Final Execution Plan:**
-{execution_plan}
+$execution_plan
+""")
 
+IMAGE_DATA_CONTEXT_TEMPLATE = Template("""
+**EXTRACTED IMAGE DATA:**
+The following data has been extracted from images using LLM analysis:
+$image_data
+
+**Important:** This image data is already extracted and available as Python variables. DO NOT attempt to reprocess images.
+""")
+
+# Prepended to generated scripts that use the extracted image data; the digest keeps cached outputs apart
+IMAGE_DATA_INJECTION_TEMPLATE = Template("""
+# Pre-extracted image data (processed by LLM, sha256 $image_digest)
+import json
+with open('/data/$image_data_filename') as _image_data_file:
+    image_extracted_data = json.load(_image_data_file)
+
+""")
+
+# Stands in for the error when a fix is drafted before the running script has finished
+SPECULATIVE_ERROR_GUESS = """Not known yet: the script is still running. Review it for the most likely runtime failures (wrong file paths, column names or dtypes, unparsed numbers, missing imports, missing final JSON print) and fix them."""
+# Errors a blind draft can fix without seeing the message; for anything else (which key, which
+# value) the real error matters, so the draft is discarded and the debugger sees it
+_GUESSED_ERROR_RE = re.compile(r'\bFileNotFoundError\b|produced no output')
+
+DEBUGGER_USER_TEMPLATE = Template("""
 **Faulty Code:**
 ```python
-{generated_code}
+$generated_code
 ```
 
 **Error Message:**
-{last_error}
+$last_error
 
 **Your Corrected, Full Python Script:**
-"""
-           
-            coder_response = claude_client.messages.create(
+""")
+
+IMAGE_ANALYSIS_USER_TEMPLATE = Template("""
+You are an expert data analyst specializing in extracting structured information from images. 
+Analyze each of the provided images and extract ALL relevant data that could help answer the user's questions.
+Each image is preceded by a line giving its filename.
+
+**User Questions/Request:**
+$question
+
+**Images Provided:**
+$image_list
+
+**Your Task (for every image):**
+1. Examine the image carefully
+2. Extract ALL numerical data, text data, tables, charts, or any structured information
+3. If there are tables, extract them in a structured format (rows and columns)
+4. If there are charts/graphs, extract the data points and values
+5. If there's text, extract key information relevant to the questions
+6. Return the extracted data in a structured JSON format
+
+**Output Format:**
+Return a single JSON object keyed by image filename, with the following structure:
+{
+    "results": {
+        "<image filename>": {
+            "extracted_data": {
+                "tables": [
+                    {"table_name": "table1", "headers": ["col1", "col2"], "rows": [["val1", "val2"], ...]},
+                    ...
+                ],
+                "charts": [
+                    {"chart_type": "bar/line/pie", "title": "chart_title", "data": {"labels": [...], "values": [...]}},
+                    ...
+                ],
+                "key_values": {
+                    "metric1": "value1",
+                    "metric2": "value2",
+                    ...
+                },
+                "text_content": "Any relevant text content...",
+                "summary": "Brief summary of what was found in the image"
+            },
+            "image_filename": "<image filename>"
+        },
+        ...
+    }
+}
+
+**Important:**
+- Include an entry for every image listed above
+- Extract actual values, not placeholders
+- Be precise with numbers and data
+- If you can't extract certain data, indicate "not_available"
+- Focus on data relevant to answering the user's questions
+""")
+
+FALLBACK_USER_TEMPLATE = Template("""
+You are tasked with generating a valid JSON response structure based on the user's question/request, even though the actual analysis failed.
+
+**Instructions:**
+1. Analyze the user's request to understand what format they expect in the response
+2. Generate a JSON response in the exact format they would expect if the analysis had succeeded
+3. For data values, use placeholder values like "N/A", "Error: Data not available", null, or empty arrays/objects as appropriate
+4. Maintain the exact structure they would expect but indicate that data is not available
+5. Do not explain the failure - just provide the expected JSON structure with placeholder values
+
+**User Request:**
+$question
+
+**Your Fallback JSON Response:**
+""")
+
+def cached_system_prompt(*texts: str) -> List[Dict[str, Any]]:
+    """Wrap prompt text as `system` blocks, each marked as a breakpoint for Anthropic prompt caching."""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}} for text in texts]
+
+_background_tasks = set()
+
+def spawn_background_task(coro):
+    """Start a fire-and-forget task, keeping a reference so it is not garbage collected."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+_claude_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CLAUDE_CALLS)
+
+# Identical requests (same model, prompts, images and limits) are answered from disk,
+# so repeated submissions and restarts do not pay for the same LLM round trip twice.
+# Replies that are scripts (acquisition, plan and code, debugger fixes) are not stored here:
+# whether they work is only known after they run, and a cached failing script would be
+# replayed on every resubmission. Scripts that ran are kept by the validated-result caches.
+claude_response_cache = diskcache.Cache(CLAUDE_CACHE_DIR)
+claude_cache_stats = {"hits": 0, "misses": 0}
+
+def claude_cache_key(kind: str, kwargs: Dict[str, Any]) -> str:
+    """SHA-256 of the full request payload; image data is part of the payload, so it is covered too."""
+    payload = orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)
+    return f"{kind}:{hashlib.sha256(payload).hexdigest()}"
+
+async def call_claude(cache: bool = True, **kwargs):
+    """Send a Claude request without blocking the event loop, within the shared concurrency cap."""
+    cache_key = claude_cache_key("message", kwargs)
+    if cache:
+        cached = claude_response_cache.get(cache_key)
+        if cached is not None:
+            claude_cache_stats["hits"] += 1
+            logger.debug("⚡ Claude response served from cache.")
+            return cached
+        claude_cache_stats["misses"] += 1
+    async with _claude_semaphore:
+        response = await claude_client.messages.create(**kwargs)
+    # A reply cut off at max_tokens is incomplete, so the next identical request asks again
+    if cache and response.stop_reason != "max_tokens":
+        claude_response_cache.set(cache_key, response, expire=CLAUDE_CACHE_TTL)
+    return response
+
+async def stream_claude_code(**kwargs) -> str:
+    """Stream a coder response, warming the Docker sandbox in the background as soon as code starts."""
+    chunks = []
+    tail = ""
+    prewarm_started = False
+    async with _claude_semaphore:
+        async with claude_client.messages.stream(**kwargs) as stream:
+            async for text in stream.text_stream:
+                chunks.append(text)
+                if not prewarm_started:
+                    window = tail + text
+                    if "```" in window:
+                        spawn_background_task(prewarm_docker_sandbox())
+                        prewarm_started = True
+                    tail = window[-2:]
+    return "".join(chunks)
+
+def split_plan_and_code(text: str) -> Tuple[str, str]:
+    """Split a combined planner/coder response into its <plan> text and <code> script."""
+    # The plan may itself mention a <code> tag, so the script tag is searched for after </plan>,
+    # or failing that, the last <code> tag is taken
+    plan_part, has_plan_end, code_part = text.partition("</plan>")
+    if has_plan_end:
+        _, has_code_tag, code_part = code_part.partition("<code>")
+    else:
+        plan_part, has_code_tag, code_part = text.rpartition("<code>")
+    if not has_code_tag:
+        # Tags were dropped: treat the last python fence as the script and the rest as the plan
+        plan_part, has_fence, code_part = text.rpartition("```python")
+        if not has_fence:
+            return text.strip(), ""
+        code_part = "```python" + code_part
+    plan = plan_part.replace("<plan>", "").replace("</plan>", "").strip()
+    if "</code>" in code_part:
+        code_part = code_part.rpartition("</code>")[0]
+    return plan, strip_code_fence(code_part)
+
+def strip_code_fence(text: str) -> str:
+    """Return the code inside the first ```python ... ``` fence of an LLM response, or the whole text."""
+    match = _CODE_FENCE_RE.search(text)
+    if not match:
+        return text.strip()
+    return match.group("block") if match.group("block") is not None else match.group("inline").strip()
+
+def extract_json(text: str) -> Optional[str]:
+    """Return the first balanced {...} object in an LLM response, ignoring braces inside strings."""
+    start = text.find('{')
+    if start == -1:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return None
+
+# --- 1. Secure Code Execution using Docker Sandbox ---
+# A pool of long-lived sandbox containers is kept warm and each script runs in a leased one
+# via `docker exec`, so executions skip container start-up and concurrent requests do not
+# queue behind a single sandbox. Every container mounts its own host workspace directory at
+# /data, and the request's files are staged into it for each run.
+SANDBOX_ROOT_DIR = os.path.join(SCRATCH_DIR, f"analyst-sandbox-{uuid.uuid4().hex[:8]}")
+
+def start_docker_container(container_name: str, data_dir: str):
+    """Start a new persistent Docker container with `data_dir` mounted at /data."""
+    # Names are unique per pool entry, so there is never an existing container to probe for
+    # first; the pool tracks which of its containers are running and drops any that vanish.
+    logger.debug("🚀 Starting persistent container '%s'...", container_name)
+    subprocess.run([
+        "docker", "run", "-dit",
+        "--name", container_name,
+        "-v", f"{data_dir}:/data",  # mount host data_dir
+        DOCKER_IMAGE_NAME, "bash"
+    ], check=True, capture_output=True)
+
+class ContainerPool:
+    """Warm pool of sandbox containers, leased out one script execution at a time."""
+
+    def __init__(self, min_size: int, max_size: int):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.containers = set()
+        self._idle = asyncio.Queue()
+        self._pending = 0  # Containers currently being started
+        self._waiting = 0  # Executions blocked in acquire() until a container is idle
+
+    def workspace_dir(self, container_name: str) -> str:
+        """Host directory mounted at /data in the given container."""
+        return os.path.join(SANDBOX_ROOT_DIR, container_name)
+
+    def _start_container(self) -> str:
+        container_name = f"analyst-sandbox-running-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.workspace_dir(container_name), exist_ok=True)
+        start_docker_container(container_name, self.workspace_dir(container_name))
+        self.containers.add(container_name)
+        return container_name
+
+    def _remove_container(self, container_name: str):
+        self.containers.discard(container_name)
+        subprocess.run(["docker", "rm", "-f", container_name], capture_output=True)
+        shutil.rmtree(self.workspace_dir(container_name), ignore_errors=True)
+
+    def start(self):
+        """Start `min_size` containers in parallel and mark them idle."""
+        missing = self.min_size - len(self.containers) - self._pending
+        if missing <= 0:
+            return
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [executor.submit(self._start_container) for _ in range(missing)]
+        for future in futures:
+            try:
+                self._idle.put_nowait(future.result())
+            except Exception as e:
+                logger.warning("⚠️ Could not start a sandbox container: %s", e)
+
+    async def prewarm(self):
+        """Start one more container in the background if none is idle and the pool has room."""
+        if self._idle.empty():
+            await self._add_idle_container()
+
+    async def _add_idle_container(self):
+        if len(self.containers) + self._pending >= self.max_size:
+            return
+        self._pending += 1
+        try:
+            self._idle.put_nowait(await asyncio.to_thread(self._start_container))
+        finally:
+            self._pending -= 1
+
+    async def acquire(self) -> str:
+        """Lease an idle container, starting a new one if none is idle and the pool has room."""
+        if self._idle.empty() and len(self.containers) + self._pending < self.max_size:
+            self._pending += 1
+            try:
+                return await asyncio.to_thread(self._start_container)
+            finally:
+                self._pending -= 1
+        self._waiting += 1
+        try:
+            return await self._idle.get()
+        finally:
+            self._waiting -= 1
+
+    async def release(self, container_name: str, healthy: bool = True):
+        """Return a leased container to the pool, or discard it if it stopped working or is single-use."""
+        if healthy and CONTAINER_REUSE_STRATEGY == "keep_alive":
+            self._idle.put_nowait(container_name)
+        else:
+            await asyncio.to_thread(self._remove_container, container_name)
+            # The freed slot is refilled right away while executions are queued, not only below min_size
+            if self._waiting or len(self.containers) < self.min_size:
+                spawn_background_task(self._replace_container())
+
+    async def _replace_container(self):
+        try:
+            await self._add_idle_container()
+        except Exception as e:
+            logger.warning("⚠️ Could not start a replacement sandbox container: %s", e)
+
+    def shutdown(self):
+        """Remove every container started by the pool and the host workspaces."""
+        for container_name in list(self.containers):
+            self._remove_container(container_name)
+        shutil.rmtree(SANDBOX_ROOT_DIR, ignore_errors=True)
+
+sandbox_pool = ContainerPool(SANDBOX_POOL_MIN_SIZE, SANDBOX_POOL_MAX_SIZE)
+
+def cleanup_docker_sandbox_at_exit():
+    """Last-chance removal of the sandbox containers if the shutdown hook did not run."""
+    if sandbox_pool.containers:
+        try:
+            sandbox_pool.shutdown()
+        except OSError:
+            pass
+
+def exit_on_sigterm(signum, frame):
+    """Turn SIGTERM into a normal interpreter exit so the atexit cleanup still runs."""
+    sys.exit(128 + signum)
+
+atexit.register(cleanup_docker_sandbox_at_exit)
+try:
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+except ValueError:
+    pass  # Not imported from the main thread; the server's own signal handling applies
+
+async def prewarm_docker_sandbox():
+    """Make sure a sandbox container is warm ahead of the next execution."""
+    try:
+        await sandbox_pool.prewarm()
+    except Exception as e:
+        logger.warning("⚠️ Sandbox pre-warm failed: %s", e)
+
+def stage_data_files(data_dir: str, workspace_dir: str):
+    """Hard-link (or copy, across filesystems) the request's data files into the sandbox workspace."""
+    for entry in os.scandir(data_dir):
+        if entry.is_file():
+            target = os.path.join(workspace_dir, entry.name)
+            try:
+                os.link(entry.path, target)
+            except OSError:
+                shutil.copy2(entry.path, target)
+
+# --- Helper function to run pipeline with timeout ---
+async def run_with_timeout(coro, timeout_seconds: int, fallback_question: str):
+    """Run a coroutine with a timeout and return fallback response if timeout occurs."""
+    deadline = asyncio.get_running_loop().time() + timeout_seconds
+    try:
+        async with asyncio.timeout_at(deadline):
+            return await coro
+    except asyncio.TimeoutError:
+        logger.warning("⏰ Pipeline timed out after %s seconds", timeout_seconds)
+        logger.info("🔄 Generating fallback response due to timeout...")
+        fallback_response = await generate_fallback_response(fallback_question, deadline)
+        logger.debug("✅ Timeout fallback response generated: %s", fallback_response)
+        return fallback_response
+    except Exception as e:
+        logger.error("❌ Unexpected error in timeout wrapper: %s", e)
+        fallback_response = await generate_fallback_response(fallback_question, deadline)
+        return fallback_response
+
+# --- Helper function to execute with timeout ---
+async def execute_python_code_docker(code: str, data_dir: str, timeout: int = DOCKER_EXECUTION_TIMEOUT) -> dict:
+    """Executes Python code in the Docker sandbox with configurable timeout, without blocking the event loop."""
+    logger.debug("🐍 EXECUTING GENERATED CODE IN A DOCKER SANDBOX 🐍 (timeout %s seconds)", timeout)
+
+    try:
+        container_name = await sandbox_pool.acquire()
+        # Only a run that finished cleaning its workspace hands the container back; after a
+        # launch error, timeout or cancellation it may still hold files or a live script.
+        container_healthy = False
+        try:
+            # Stage the data files into the workspace mounted at /data
+            stage_data_files(data_dir, sandbox_pool.workspace_dir(container_name))
+
+            # Run inside the leased container; the script is piped to `python -` on stdin, so it
+            # never touches the filesystem. `timeout` stops the script in the container itself
+            # and the workspace is emptied afterwards so nothing leaks between runs.
+            docker_command = [
+                "docker", "exec", "-i", container_name,
+                "sh", "-c",
+                f"timeout -k 5 {timeout} python -; status=$?; "
+                "find /data -mindepth 1 -delete; exit $status"
+            ]
+            logger.debug("--- Executing Docker command: %s ---", ' '.join(docker_command))
+
+            # Capture raw bytes; only the stream we actually use is decoded below
+            process = await asyncio.create_subprocess_exec(
+                *docker_command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                async with asyncio.timeout(timeout + 10):
+                    stdout, stderr = await process.communicate(code.encode('utf-8'))
+            except BaseException:
+                # Timed out or cancelled: stop the exec client, the container is discarded below
+                process.kill()
+                await process.wait()
+                raise
+            error_output = stderr.decode('utf-8', errors='replace').strip() if process.returncode != 0 else ""
+
+            # If the container went away underneath us it is dropped so the pool starts a fresh one
+            container_healthy = "No such container" not in error_output and "is not running" not in error_output
+        finally:
+            await sandbox_pool.release(container_name, container_healthy)
+
+        if process.returncode == 124:
+            logger.warning("⏰ Docker command timed out after %s seconds", timeout)
+            return {"output": None, "error": f"Docker command timed out after {timeout} seconds"}
+
+        if process.returncode == 0:
+            output = stdout.decode('utf-8', errors='replace').strip()
+            logger.debug("✅ Docker execution SUCCESSFUL.")
+            if not output:
+                logger.warning("⚠️ WARNING: Script ran successfully but produced NO output.")
+                return {
+                    "output": None,
+                    "error": "Script ran without errors but produced no output. The final print() statement is likely missing."
+                }
+
+            try:
+                # Parse the raw bytes directly; orjson skips building an intermediate str
+                parsed_output = orjson.loads(stdout)
+                if isinstance(parsed_output, dict) and "error" in parsed_output:
+                    logger.warning("❌ Docker execution FAILED. Script returned a JSON error.")
+                    logger.debug(">>> CAPTURED ERROR:\n%s", parsed_output['error'])
+                    return {"output": None, "error": parsed_output['error']}
+            except orjson.JSONDecodeError:
+                pass
+
+            logger.debug(">>> CAPTURED OUTPUT (Truncated):\n%s...", output[:1000])
+            return {"output": output, "error": None}
+        else:
+            logger.warning("❌ Docker execution FAILED.")
+            logger.debug(">>> CAPTURED ERROR:\n%s", error_output)
+            return {"output": None, "error": error_output}
+
+    except asyncio.TimeoutError:
+        logger.warning("⏰ Docker command timed out after %s seconds", timeout)
+        return {"output": None, "error": f"Docker command timed out after {timeout} seconds"}
+    except Exception as e:
+        logger.error("❌ Docker launch ERROR: %s", e)
+        if "No such file or directory" in str(e) or "not found" in str(e):
+            return {
+                "output": None,
+                "error": f"Docker command failed. Is Docker installed and running? Have you built the '{DOCKER_IMAGE_NAME}' image?"
+            }
+        return {"output": None, "error": str(e)}
+
+def build_fallback_skeleton(question: str) -> Optional[str]:
+    """Placeholder answer shaped from the question alone, or None when its shape is not obvious."""
+    # Only an explicitly requested array has a known shape; object keys are only known to the LLM
+    if not _ARRAY_ANSWER_RE.search(question):
+        return None
+    question_count = len(_NUMBERED_QUESTION_RE.findall(question))
+    if question_count:
+        return orjson.dumps(["N/A"] * question_count).decode()
+    return None
+
+# Successful outputs keyed by script and data content: a rephrased question that yields the
+# same script on the same files does not pay for another sandbox run.
+execution_result_cache = diskcache.Cache(EXECUTION_CACHE_DIR)
+
+async def execute_python_code_cached(code: str, data_dir: str, data_hash: Optional[str], timeout: int = DOCKER_EXECUTION_TIMEOUT) -> dict:
+    """Execute code in the sandbox, reusing the output of an identical earlier run on the same data."""
+    if data_hash is None:
+        return await execute_python_code_docker(code, data_dir, timeout)
+    cache_key = f"{hashlib.sha256(code.encode('utf-8')).hexdigest()}:{data_hash}"
+    cached_output = execution_result_cache.get(cache_key)
+    if cached_output is not None:
+        logger.debug("⚡ Script output served from the execution cache.")
+        return {"output": cached_output, "error": None}
+    execution_result = await execute_python_code_docker(code, data_dir, timeout)
+    if execution_result["output"]:
+        execution_result_cache.set(cache_key, execution_result["output"], expire=EXECUTION_CACHE_TTL)
+    return execution_result
+
+async def generate_fallback_response(question: str, deadline: Optional[float] = None) -> str:
+    """Generate a fallback JSON response when analysis fails, within the time left before `deadline`."""
+    logger.info("--- Generating Fallback Response ---")
+
+    # This is the error path, usually taken when time is already short, so the LLM is
+    # only asked when the answer shape cannot be guessed and there is budget left for it.
+    skeleton = build_fallback_skeleton(question)
+    if skeleton:
+        logger.info("✅ Fallback JSON skeleton built from the question")
+        return skeleton
+    remaining = deadline - asyncio.get_running_loop().time() if deadline is not None else None
+    if remaining is not None and remaining < FALLBACK_MIN_LLM_SECONDS:
+        logger.warning("⏰ No time left for an LLM fallback, returning a minimal response.")
+        return orjson.dumps({"error": "timeout", "result": None}).decode()
+    
+    fallback_prompt = FALLBACK_USER_TEMPLATE.substitute(question=question)
+    
+    try:
+        async with asyncio.timeout(remaining):
+            fallback_response = await call_claude(
                 model="claude-3-5-sonnet-20241022",
-                max_tokens=4000,
-                messages=[{"role": "user", "content": coder_prompt}]
+                max_tokens=2000,
+                messages=[{"role": "user", "content": fallback_prompt}]
             )
-            generated_code = coder_response.content[0].text.strip().lstrip("```python").rstrip("```")
+        
+        response_text = fallback_response.content[0].text.strip()
+        
+        # Extract JSON from response
+        fallback_json = extract_json(response_text)
+        if fallback_json:
+            # Validate it's proper JSON
+            orjson.loads(fallback_json)  # This will raise an exception if invalid
+            logger.info("✅ Fallback JSON Response Generated")
+            return fallback_json
+        else:
+            # If no JSON found, create a basic error response
+            return orjson.dumps({"error": "Analysis failed", "result": "Data not available"}).decode()
             
-            # Inject the image data at the beginning of the script
-            if image_extracted_data:
-                image_data_injection = f"""
-# Pre-extracted image data (processed by LLM)
-import json
-image_extracted_data = {json.dumps(image_extracted_data, indent=2)}
+    except Exception as e:
+        logger.error("❌ Error generating fallback response: %s", e)
+        # Last resort fallback
+        return orjson.dumps({"error": "Analysis failed", "result": "Data not available"}).decode()
 
-"""
+def find_image_names(files: Dict[str, str]) -> set:
+    """Names of the uploaded files that are images, computed once per request."""
+    return {name for name in files if os.path.splitext(name)[1].lower() in IMAGE_EXTS}
+
+# --- 2. Helper Function to Create File Previews ---
+def create_file_previews(files: Dict[str, str], image_names: set) -> str:
+    # Every line goes into one flat list that is joined exactly once at the end
+    preview_parts: List[str] = []
+    for name, path in files.items():
+        preview_parts.append(f"--- File: {name} ---")
+        if name in image_names:
+            preview_parts.append(f"Image file, Size: {os.path.getsize(path)} bytes")
+        else:
+            # Only a bounded prefix is read and decoded, whatever the file size
+            with open(path, 'rb') as f:
+                head = f.read(FILE_PREVIEW_BYTES)
+            if b"\x00" in head:
+                # Text formats never contain NUL bytes, so this is a binary file
+                preview_parts.append(f"Binary file, Size: {os.path.getsize(path)} bytes")
+            else:
+                # final=False tolerates a multi-byte character cut off at the end of the prefix
+                text_content = codecs.getincrementaldecoder('utf-8')(errors='replace').decode(head, final=False)
+                lines = text_content.splitlines()
+                preview_parts.extend(lines[:20])
+                if len(lines) > 20 or os.path.getsize(path) > len(head):
+                    preview_parts.append("... (file truncated)")
+        preview_parts.append("-" * (len(name) + 10))
+    return "\n".join(preview_parts)
+
+# --- 2.5. Helper Function to Process Images with LLM ---
+IMAGE_MEDIA_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+    'webp': 'image/webp'
+}
+
+async def process_images_with_llm(question: str, files: Dict[str, str], image_names: set) -> Dict[str, Any]:
+    """Process images using LLM to extract relevant data based on questions."""
+    image_files = {name: path for name, path in files.items() if name in image_names}
+    
+    if not image_files:
+        return {}
+    
+    # Images go into as few multimodal requests as the payload and output caps allow, so the
+    # instruction prompt and the round trip are paid once per batch instead of once per image.
+    batches: List[List[Tuple[str, str, str]]] = [[]]
+    batch_bytes = 0
+    for image_name, image_path in image_files.items():
+        # Convert image bytes to base64 for LLM processing; base64 output is pure ASCII,
+        # which decodes faster than the general UTF-8 path
+        with open(image_path, 'rb') as f:
+            image_content = f.read()
+        image_base64 = base64.b64encode(memoryview(image_content)).decode('ascii')
+        del image_content  # Only the encoded form is kept for the request
+        media_type = IMAGE_MEDIA_TYPES.get(image_name.split('.')[-1].lower(), 'image/jpeg')
+        if batches[-1] and (batch_bytes + len(image_base64) > IMAGE_BATCH_MAX_BYTES or len(batches[-1]) >= IMAGE_BATCH_MAX_IMAGES):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append((image_name, media_type, image_base64))
+        batch_bytes += len(image_base64)
+
+    image_analysis_results = {}
+    for batch_results in await asyncio.gather(*(extract_image_batch(question, batch) for batch in batches)):
+        image_analysis_results.update(batch_results)
+    return image_analysis_results
+
+async def extract_image_batch(question: str, batch: List[Tuple[str, str, str]]) -> Dict[str, Any]:
+    """Ask the LLM for structured data from a batch of (name, media_type, base64) images in one request."""
+    image_names = [image_name for image_name, _, _ in batch]
+    logger.info("--- Processing Images: %s with LLM ---", ', '.join(image_names))
+
+    image_analysis_prompt = IMAGE_ANALYSIS_USER_TEMPLATE.substitute(
+        question=question,
+        image_list="\n".join(f"- {image_name}" for image_name in image_names)
+    )
+
+    content: List[Dict[str, Any]] = [{"type": "text", "text": image_analysis_prompt}]
+    for image_name, media_type, image_base64 in batch:
+        content.append({"type": "text", "text": f"Image: {image_name}"})
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": image_base64
+            }
+        })
+
+    try:
+        response = await call_claude(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=IMAGE_OUTPUT_TOKENS * len(batch),
+            messages=[{"role": "user", "content": content}]
+        )
+        
+        response_text = response.content[0].text
+        
+        # Extract JSON from response
+        json_text = extract_json(response_text)
+        if not json_text and len(batch) > 1:
+            # Usually a response cut off at max_tokens: each image gets its own request instead
+            logger.warning("⚠️ Batch response for %s did not parse. Retrying image by image...", ', '.join(image_names))
+            batch_results = {}
+            for single_results in await asyncio.gather(*(extract_image_batch(question, [image]) for image in batch)):
+                batch_results.update(single_results)
+            return batch_results
+        if not json_text:
+            logger.warning("❌ Could not extract structured data from %s", ', '.join(image_names))
+            return {image_name: {"error": "Could not parse LLM response"} for image_name in image_names}
+
+        results = orjson.loads(json_text).get("results", {})
+        batch_results = {}
+        for image_name in image_names:
+            if isinstance(results.get(image_name), dict):
+                batch_results[image_name] = results[image_name]
+                logger.info("✅ Successfully extracted data from %s", image_name)
+            else:
+                logger.warning("❌ Could not extract structured data from %s", image_name)
+                batch_results[image_name] = {"error": "No data returned for this image"}
+        return batch_results
+
+    except Exception as e:
+        logger.error("❌ Error processing images %s: %s", ', '.join(image_names), e)
+        return {image_name: {"error": str(e)} for image_name in image_names}
+
+def image_data_for_prompt(image_extracted_data: Dict[str, Any]) -> str:
+    """Compact, size-capped JSON of the extracted image data for embedding in an LLM prompt."""
+    prompt_data = {}
+    for image_name, image_data in image_extracted_data.items():
+        if isinstance(image_data, dict):
+            # The filename is already the key, and long free text is trimmed to a summary-sized prefix
+            image_data = {key: value for key, value in image_data.items() if key != "image_filename"}
+            extracted = image_data.get("extracted_data")
+            if isinstance(extracted, dict) and isinstance(extracted.get("text_content"), str):
+                text_content = extracted["text_content"]
+                if len(text_content) > IMAGE_TEXT_CONTENT_LIMIT:
+                    image_data["extracted_data"] = {**extracted, "text_content": text_content[:IMAGE_TEXT_CONTENT_LIMIT] + "..."}
+        prompt_data[image_name] = image_data
+    serialized = orjson.dumps(prompt_data)
+    if len(serialized) > MAX_PROMPT_EMBED_BYTES:
+        return serialized[:MAX_PROMPT_EMBED_BYTES].decode('utf-8', errors='ignore') + "...<truncated>"
+    return serialized.decode()
+
+# --- 2.7. Cache of Successful Runs Keyed by Request Content ---
+_pipeline_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+
+def compute_data_hash(files: Dict[str, str]) -> str:
+    """Content hash of a request's data: every file's name and contents."""
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        with open(files[name], 'rb') as f:
+            file_digest = hashlib.file_digest(f, "sha256").digest()
+        digest.update(b"|" + name.encode("utf-8") + b"|" + file_digest)
+    return digest.hexdigest()
+
+def compute_request_key(question: str, data_hash: str) -> str:
+    """Content hash of a request: the question plus the hash of its data files."""
+    return hashlib.sha256(f"{question}|{data_hash}".encode("utf-8")).hexdigest()
+
+def remember_successful_run(request_key: str, execution_plan: str, generated_code: str, output: str, image_extracted_data: Optional[Dict] = None):
+    """Store the plan and script that answered a request, evicting the oldest entry when full."""
+    _pipeline_cache[request_key] = {"plan": execution_plan, "code": generated_code, "output": output, "image_data": image_extracted_data}
+    _pipeline_cache.move_to_end(request_key)
+    while len(_pipeline_cache) > PIPELINE_CACHE_SIZE:
+        _pipeline_cache.popitem(last=False)
+
+def write_image_data_file(data_dir: str, image_extracted_data: Dict) -> str:
+    """Write the image data into the request's data directory once and return the header that loads it."""
+    image_json = orjson.dumps(image_extracted_data)
+    # Parallel batch questions write the same file, so it is replaced atomically
+    temp_path = os.path.join(data_dir, f".{IMAGE_DATA_FILENAME}.{uuid.uuid4().hex}")
+    with open(temp_path, 'wb') as f:
+        f.write(image_json)
+    os.replace(temp_path, os.path.join(data_dir, IMAGE_DATA_FILENAME))
+    return IMAGE_DATA_INJECTION_TEMPLATE.substitute(
+        image_digest=hashlib.sha256(image_json).hexdigest()[:16],
+        image_data_filename=IMAGE_DATA_FILENAME
+    )
+
+# --- 2.6. Helper Function to Request a Data Acquisition Script ---
+async def request_acquisition_script(question: str, non_image_files: List[str], acquisition_error: Optional[str] = None):
+    """Ask Claude for a script that previews the structure of the non-image data."""
+    acquisition_prompt = ACQUISITION_USER_TEMPLATE.substitute(
+        non_image_files=non_image_files,
+        question=question,
+        previous_error=f"**Previous Acquisition Error:** {acquisition_error}" if acquisition_error else ""
+    )
+    return await call_claude(
+        cache=False,  # A script; the structure it captures is cached once it has run
+        model="claude-3-5-sonnet-20241022",
+        max_tokens=1024,  # Preview scripts are short
+        system=cached_system_prompt(ACQUISITION_SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": acquisition_prompt}]
+    )
+
+async def request_plan_and_code(question: str, image_extracted_data: Dict[str, Any], actual_data_structure: str, model: str) -> str:
+    """Ask Claude for the execution plan and the first script in one streamed response."""
+    # Prepare image data context for the planner
+    image_data_context = ""
+    if image_extracted_data:
+        image_data_context = IMAGE_DATA_CONTEXT_TEMPLATE.substitute(image_data=image_data_for_prompt(image_extracted_data))
+
+    plan_and_code_prompt = PLAN_AND_CODE_USER_TEMPLATE.substitute(
+        image_data_context=image_data_context,
+        question=question,
+        actual_data_structure=actual_data_structure
+    )
+
+    return await stream_claude_code(
+        model=model,
+        max_tokens=8000,
+        system=cached_system_prompt(PLAN_AND_CODE_SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": plan_and_code_prompt}]
+    )
+
+async def request_debugged_script(generated_code: str, last_error: str, debugger_context: str) -> str:
+    """Ask Claude to fix a failing script and return the corrected code."""
+    coder_prompt = DEBUGGER_USER_TEMPLATE.substitute(
+        generated_code=generated_code,
+        last_error=last_error
+    )
+    coder_response_text = await stream_claude_code(
+        model="claude-3-5-sonnet-20241022",
+        max_tokens=4000,
+        system=cached_system_prompt(DEBUGGER_SYSTEM_PROMPT, debugger_context),
+        messages=[{"role": "user", "content": coder_prompt}]
+    )
+    return strip_code_fence(coder_response_text)
+
+# --- 2.8. Chief Strategist Decision, Cached per Question and File Names ---
+_strategy_cache: "OrderedDict[Tuple[str, Tuple[str, ...]], Dict[str, Any]]" = OrderedDict()
+
+async def decide_strategy(question: str, files: Dict[str, str], image_names: set) -> Dict[str, Any]:
+    """Ask the Chief Strategist how to handle a request, reusing the decision for a repeated question."""
+    cache_key = (question, tuple(sorted(files)))
+    cached_strategy = _strategy_cache.get(cache_key)
+    if cached_strategy is not None:
+        _strategy_cache.move_to_end(cache_key)
+        logger.debug("✅ Reusing cached strategy decision")
+        return dict(cached_strategy)
+
+    file_previews = create_file_previews(files, image_names)
+    has_images = bool(image_names)
+   
+    strategist_prompt = STRATEGIST_USER_TEMPLATE.substitute(
+        question=question,
+        file_previews=file_previews,
+        has_images=has_images
+    )
+    strategist_response = await call_claude(
+        model="claude-3-5-sonnet-20241022",
+        max_tokens=128,  # The decision is four small tool arguments
+        system=cached_system_prompt(STRATEGIST_SYSTEM_PROMPT),
+        tools=[STRATEGY_TOOL],
+        tool_choice={"type": "tool", "name": STRATEGY_TOOL["name"]},
+        messages=[{"role": "user", "content": strategist_prompt}]
+    )
+    tool_call = next((block for block in strategist_response.content if block.type == "tool_use"), None)
+    if tool_call is None:
+        raise ValueError("Strategist LLM did not record a strategy decision.")
+    strategy = dict(tool_call.input)
+
+    _strategy_cache[cache_key] = strategy
+    while len(_strategy_cache) > STRATEGY_CACHE_SIZE:
+        _strategy_cache.popitem(last=False)
+    return dict(strategy)
+
+# --- 2.9. Validated Scripts Reused for the Same Question ---
+# Questions only match when they are identical after case and whitespace folding: a single
+# changed word, operator or sign ("highest"/"lowest", ">"/"<", "5"/"-5") can flip the answer,
+# so neither fuzzy similarity nor dropping punctuation is safe here. Only scripts that ran
+# successfully are stored, and only for the same data context (data structure, image data
+# and file names).
+_script_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+def normalize_question(question: str) -> str:
+    """Case-fold the question and collapse whitespace."""
+    return " ".join(question.casefold().split())
+
+def compute_context_hash(actual_data_structure: str, image_extracted_data: Dict[str, Any], files: Dict[str, str]) -> str:
+    """Hash of everything besides the question that a generated script depends on."""
+    digest = hashlib.sha256(actual_data_structure.encode('utf-8'))
+    digest.update(orjson.dumps(image_extracted_data, option=orjson.OPT_SORT_KEYS))
+    digest.update("|".join(sorted(files)).encode('utf-8'))
+    return digest.hexdigest()
+
+def script_cache_key(question: str, context_hash: str) -> str:
+    """Key of a validated script: the normalized question plus its data context."""
+    return hashlib.sha256(f"{normalize_question(question)}|{context_hash}".encode('utf-8')).hexdigest()
+
+def lookup_validated_script(question: str, context_hash: str) -> Optional[Dict[str, Any]]:
+    """Plan and script that already answered this question on the same data."""
+    cache_key = script_cache_key(question, context_hash)
+    entry = _script_cache.get(cache_key)
+    if entry is None:
+        return None
+    if entry["stored_at"] < time.time() - SCRIPT_CACHE_TTL:
+        del _script_cache[cache_key]
+        return None
+    _script_cache.move_to_end(cache_key)
+    logger.info("✅ Found a validated script for the same question")
+    return entry
+
+def remember_validated_script(question: str, context_hash: str, execution_plan: str, script: str):
+    """Store a script that ran successfully, evicting the oldest entry when full."""
+    cache_key = script_cache_key(question, context_hash)
+    _script_cache[cache_key] = {
+        "plan": execution_plan,
+        "code": script,
+        "stored_at": time.time(),
+    }
+    _script_cache.move_to_end(cache_key)
+    while len(_script_cache) > SCRIPT_CACHE_SIZE:
+        _script_cache.popitem(last=False)
+
+# --- 2.10. Model Tiering for the First Attempt ---
+# The first plan and script come from the faster model; a question whose first script
+# failed once goes straight to Sonnet on later submissions.
+_escalated_questions: "OrderedDict[str, bool]" = OrderedDict()
+
+def choose_plan_model(question: str) -> str:
+    """Model for the plan and first script of a question."""
+    question_key = normalize_question(question)
+    if question_key in _escalated_questions:
+        _escalated_questions.move_to_end(question_key)
+        return "claude-3-5-sonnet-20241022"
+    return FAST_CODER_MODEL
+
+def escalate_question(question: str):
+    """Remember that the fast model's first script failed for this question."""
+    question_key = normalize_question(question)
+    _escalated_questions[question_key] = True
+    _escalated_questions.move_to_end(question_key)
+    while len(_escalated_questions) > ESCALATION_CACHE_SIZE:
+        _escalated_questions.popitem(last=False)
+
+# --- 2.11. Captured Data Structures Keyed by Question and Uploaded Data Content ---
+# The acquisition script previews what the question needs (its columns and unique values), so a
+# structure is only reused for the same question, e.g. when its earlier run failed in Stage 4.
+_data_structure_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def lookup_data_structure(question: str, data_hash: Optional[str]) -> Optional[str]:
+    """Structure captured by an earlier acquisition run for this question over the same uploaded files, if any."""
+    if data_hash is None:
+        return None
+    cache_key = compute_request_key(question, data_hash)
+    data_structure = _data_structure_cache.get(cache_key)
+    if data_structure is not None:
+        _data_structure_cache.move_to_end(cache_key)
+    return data_structure
+
+def remember_data_structure(question: str, data_hash: Optional[str], data_structure: str):
+    """Store a successfully captured structure; without uploads it describes live data and is not kept."""
+    if data_hash is None:
+        return
+    cache_key = compute_request_key(question, data_hash)
+    _data_structure_cache[cache_key] = data_structure
+    _data_structure_cache.move_to_end(cache_key)
+    while len(_data_structure_cache) > DATA_STRUCTURE_CACHE_SIZE:
+        _data_structure_cache.popitem(last=False)
+
+# --- 3. Main Analysis Pipeline ---
+async def prepare_analysis_context(question: str, files: Dict[str, str], data_dir: str, execution_data_hash: Optional[str], plan_model: str) -> Dict[str, Any]:
+    """Stages 1-2: decide the strategy, extract image data and capture the structure of the data files."""
+    # --- STAGE 1: STRATEGIC PLANNING ---
+    logger.info("--- STAGE 1: Calling Chief Strategist LLM ---")
+   
+    # Image files are classified once here and reused by every stage below
+    image_names = find_image_names(files)
+    # Filter out image files for traditional data acquisition
+    non_image_files = [name for name in files if name not in image_names]
+
+    # Scouting is required for nearly every request, so the first acquisition script is
+    # requested speculatively alongside the strategist and cancelled if it turns out unused.
+    strategist_task = asyncio.create_task(decide_strategy(question, files, image_names))
+    acquisition_task = asyncio.create_task(request_acquisition_script(question, non_image_files))
+    try:
+        strategy = await strategist_task
+    except Exception:
+        acquisition_task.cancel()
+        raise
+    logger.debug("✅ Strategy Decided: %s", strategy)
+    # A repeated question on the same uploads reuses the structure captured the first time
+    cached_data_structure = lookup_data_structure(question, execution_data_hash) if strategy.get("scouting_required", False) else None
+    if not strategy.get("scouting_required", False) or cached_data_structure is not None:
+        acquisition_task.cancel()
+
+    # --- STAGE 1.5: IMAGE PROCESSING (if required) ---
+    image_extracted_data = {}
+    if strategy.get("image_processing_required", False):
+        logger.info("--- STAGE 1.5: Processing Images with LLM ---")
+        image_extracted_data = await process_images_with_llm(question, files, image_names)
+        logger.info("✅ Image Data Extracted: %s images processed", len(image_extracted_data))
+
+    # --- STAGE 2: DATA ACQUISITION WITH ERROR HANDLING (for non-image files) ---
+    actual_data_structure = "Not available. Plan must be based on the user's provided schema."
+    speculative_plan_task = None
+    if cached_data_structure is not None:
+        logger.info("--- STAGE 2: Reusing the data structure captured for this question and files ---")
+        actual_data_structure = cached_data_structure
+    elif strategy.get("scouting_required", False):
+        logger.info("--- STAGE 2: Generating and Executing Data Acquisition Script ---")
+        
+        acquisition_success = False
+        acquisition_attempt = 0
+        acquisition_error = None
+        
+        while acquisition_attempt <= MAX_ACQUISITION_RETRIES and not acquisition_success:
+            acquisition_attempt += 1
+            logger.debug("--- Data Acquisition Attempt %s ---", acquisition_attempt)
+            
+            # Calculate remaining time for acquisition timeout
+            remaining_time = max(60, DOCKER_EXECUTION_TIMEOUT // 2)  # At least 1 minute, or half the default timeout
+            logger.debug("⏰ Data acquisition timeout set to %s seconds", remaining_time)
+            
+            if acquisition_attempt == 1:
+                acquisition_response = await acquisition_task
+            else:
+                acquisition_response = await request_acquisition_script(question, non_image_files, acquisition_error)
+            acquisition_code = strip_code_fence(acquisition_response.content[0].text)
+
+            logger.debug("%s", acquisition_code)
+           
+            if acquisition_attempt > MAX_ACQUISITION_RETRIES:
+                # Last attempt after a failure: should it fail too, the planner is asked without the
+                # data structure, so that call starts now and runs behind the Docker execution.
+                failed_data_structure = f"Data acquisition failed. Error: {acquisition_error}. Proceeding without detailed data structure."
+                speculative_plan_task = asyncio.create_task(
+                    request_plan_and_code(question, image_extracted_data, failed_data_structure, plan_model)
+                )
+
+            # Use timeout-enabled execution for data acquisition
+            try:
+                acquisition_result = await execute_python_code_cached(acquisition_code, data_dir, execution_data_hash, remaining_time)
+            except BaseException:
+                if speculative_plan_task is not None:
+                    speculative_plan_task.cancel()
+                raise
+            
+            if acquisition_result["output"]:
+                actual_data_structure = acquisition_result["output"]
+                logger.debug("✅ Data Structure Captured:\n%s", actual_data_structure)
+                acquisition_success = True
+                remember_data_structure(question, execution_data_hash, actual_data_structure)
+                if speculative_plan_task is not None:
+                    speculative_plan_task.cancel()
+                    speculative_plan_task = None
+            else:
+                acquisition_error = acquisition_result["error"]
+                logger.warning("❌ Data Acquisition Failed (Attempt %s): %s", acquisition_attempt, acquisition_error)
+                
+                if acquisition_attempt > MAX_ACQUISITION_RETRIES:
+                    logger.warning("⚠️ Data acquisition failed after %s attempts. Continuing without data structure context...", MAX_ACQUISITION_RETRIES + 1)
+                    # The speculative planner call was built from this same notice
+                    actual_data_structure = failed_data_structure
+
+    return {
+        "image_extracted_data": image_extracted_data,
+        "actual_data_structure": actual_data_structure,
+        # Already running planner call for this question, if the last acquisition retry started one
+        "speculative_plan_task": speculative_plan_task,
+    }
+
+async def run_analysis_pipeline(question: str, files: Dict[str, str], data_dir: str, request_key: Optional[str] = None, data_hash: Optional[str] = None, shared_context: Optional[Dict[str, Any]] = None) -> Any:
+    """Runs the full, dynamic analysis pipeline using Claude models; `shared_context` skips Stages 1-2."""
+
+    # --- CACHE CHECK: an identical request already has a working script ---
+    if request_key is None:
+        data_hash = data_hash or compute_data_hash(files)
+        request_key = compute_request_key(question, data_hash)
+    # Scripts without uploaded data usually fetch live data from the web, so their output is never reused
+    execution_data_hash = (data_hash or compute_data_hash(files)) if files else None
+    cached_run = _pipeline_cache.get(request_key)
+    if cached_run:
+        logger.info("--- CACHE HIT: Re-running the previously successful script (skipping Stages 1-3) ---")
+        if cached_run["image_data"]:
+            write_image_data_file(data_dir, cached_run["image_data"])
+        execution_result = await execute_python_code_cached(cached_run["code"], data_dir, execution_data_hash)
+        if execution_result["output"]:
+            remember_successful_run(request_key, cached_run["plan"], cached_run["code"], execution_result["output"], cached_run["image_data"])
+            logger.info("🎉 --- PIPELINE SUCCESSFUL (cached script) --- 🎉")
+            return execution_result["output"]
+        logger.warning("⚠️ Cached script failed. Running the full pipeline...")
+        _pipeline_cache.pop(request_key, None)
+   
+    plan_model = choose_plan_model(question)
+    if shared_context is None:
+        shared_context = await prepare_analysis_context(question, files, data_dir, execution_data_hash, plan_model)
+    image_extracted_data = shared_context["image_extracted_data"]
+    actual_data_structure = shared_context["actual_data_structure"]
+    speculative_plan_task = shared_context.get("speculative_plan_task")
+
+    # --- STAGE 3: ANALYSIS PLANNING (and the first script, in the same call) ---
+    context_hash = compute_context_hash(actual_data_structure, image_extracted_data, files)
+    validated_script = lookup_validated_script(question, context_hash)
+    if validated_script is not None:
+        logger.info("--- STAGE 3: Reusing a validated script (skipping the Analysis Planner) ---")
+        if speculative_plan_task is not None:
+            speculative_plan_task.cancel()
+        execution_plan, first_script = validated_script["plan"], validated_script["code"]
+    else:
+        logger.info("--- STAGE 3: Calling Analysis Planner with Full Context ---")
+        if speculative_plan_task is not None:
+            plan_and_code_text = await speculative_plan_task
+        else:
+            plan_and_code_text = await request_plan_and_code(question, image_extracted_data, actual_data_structure, plan_model)
+        execution_plan, first_script = split_plan_and_code(plan_and_code_text)
+    logger.debug("✅ Final Execution Plan Generated:\n%s", execution_plan)
+
+    # --- STAGE 4: FINAL EXECUTION & DEBUGGING WITH FALLBACK ---
+    logger.info("--- STAGE 4: Executing the Generated Script ---")
+   
+    generated_code = ""
+    last_error = ""
+    debugger_context = DEBUGGER_CONTEXT_TEMPLATE.substitute(
+        actual_data_structure=actual_data_structure,
+        question=question,
+        execution_plan=execution_plan
+    )
+    
+    # The image data is written to /data once; every attempt gets a short header that loads it
+    image_data_injection = ""
+    if image_extracted_data:
+        image_data_injection = write_image_data_file(data_dir, image_extracted_data)
+
+    speculative_fix_task = None
+    try:
+        for attempt in range(MAX_DEBUG_RETRIES):
+            logger.debug("--- Attempt %s of %s ---", attempt + 1, MAX_DEBUG_RETRIES)
+            
+            # Calculate remaining timeout for each attempt - progressively shorter
+            base_timeout = DOCKER_EXECUTION_TIMEOUT
+            attempt_timeout = max(60, base_timeout - (attempt * 30))  # Reduce timeout by 30s each attempt, minimum 60s
+            logger.debug("⏰ Execution timeout for attempt %s: %s seconds", attempt + 1, attempt_timeout)
+           
+            if attempt == 0:
+                # The first script came back together with the plan
+                generated_code = first_script
+            else:
+                drafted_code = None
+                if speculative_fix_task is not None:
+                    # The draft never saw the real error, so it is only trusted for errors the guess covers
+                    if _GUESSED_ERROR_RE.search(last_error or ""):
+                        drafted_code = await speculative_fix_task
+                    else:
+                        speculative_fix_task.cancel()
+                    speculative_fix_task = None
+                if drafted_code and drafted_code.strip() != generated_code.strip():
+                    logger.info("--- Code failed. Using the fix drafted while it ran. ---")
+                    generated_code = drafted_code
+                else:
+                    # Nothing usable was drafted, or the draft found nothing to change: debug with the real error
+                    logger.info("--- Code failed. Calling LLM in Debug Mode. ---")
+                    generated_code = await request_debugged_script(generated_code, last_error, debugger_context)
+            script_body = generated_code
+            
+            # Inject the image data loader only into scripts that read it
+            if image_data_injection and "image_extracted_data" in generated_code:
                 generated_code = image_data_injection + generated_code
            
-            print(f"✅ Final Script Generated (Attempt {attempt + 1}):\n--- SCRIPT START ---\n{generated_code}\n--- SCRIPT END ---")
+            logger.debug("✅ Final Script Generated (Attempt %s):\n--- SCRIPT START ---\n%s\n--- SCRIPT END ---", attempt + 1, generated_code)
 
-            # Use timeout-enabled execution with progressive timeout reduction
-            execution_result = execute_python_code_docker_with_timeout(generated_code, data_dir, attempt_timeout)
+            if not _CODE_MARKER_RE.search(script_body):
+                # Not worth a sandbox run: go straight to the debugger with this as the error
+                logger.warning("⚠️ LLM reply contains no Python code. Skipping execution.")
+                execution_result = {"output": None, "error": "The reply contained no Python code. Return only the complete Python script."}
+            else:
+                if SPECULATIVE_DEBUG_RETRIES and attempt < MAX_DEBUG_RETRIES - 1:
+                    # The debugger's latency hides behind the execution; the draft is dropped on success
+                    speculative_fix_task = asyncio.create_task(
+                        request_debugged_script(generated_code, SPECULATIVE_ERROR_GUESS, debugger_context)
+                    )
+
+                # Use timeout-enabled execution with progressive timeout reduction
+                execution_result = await execute_python_code_cached(generated_code, data_dir, execution_data_hash, attempt_timeout)
            
             if execution_result["output"]:
-                print("\n🎉 --- PIPELINE SUCCESSFUL --- 🎉")
+                remember_successful_run(request_key, execution_plan, generated_code, execution_result["output"], image_extracted_data)
+                remember_validated_script(question, context_hash, execution_plan, script_body)
+                logger.info("🎉 --- PIPELINE SUCCESSFUL --- 🎉")
                 return execution_result["output"]
             else:
                 last_error = execution_result["error"]
+                if attempt == 0 and validated_script is None and plan_model == FAST_CODER_MODEL:
+                    escalate_question(question)
                 if attempt == MAX_DEBUG_RETRIES - 1:
-                    print(f"\n❌ --- PIPELINE FAILED AFTER {MAX_DEBUG_RETRIES} ATTEMPTS --- ❌")
+                    logger.error("❌ --- PIPELINE FAILED AFTER %s ATTEMPTS --- ❌", MAX_DEBUG_RETRIES)
                     # Instead of raising exception, generate fallback response
-                    print("🔄 Generating fallback response...")
-                    fallback_response = generate_fallback_response(question)
-                    print(f"✅ Fallback response generated: {fallback_response}")
+                    logger.info("🔄 Generating fallback response...")
+                    fallback_response = await generate_fallback_response(question)
+                    logger.debug("✅ Fallback response generated: %s", fallback_response)
                     return fallback_response
 
     except Exception as e:
         # Handle any unexpected errors in the execution pipeline
-        print(f"❌ Unexpected error in execution pipeline: {str(e)}")
-        print("🔄 Generating fallback response due to unexpected error...")
-        fallback_response = generate_fallback_response(question)
-        print(f"✅ Fallback response generated: {fallback_response}")
+        logger.error("❌ Unexpected error in execution pipeline: %s", e)
+        logger.info("🔄 Generating fallback response due to unexpected error...")
+        fallback_response = await generate_fallback_response(question)
+        logger.debug("✅ Fallback response generated: %s", fallback_response)
         return fallback_response
+    finally:
+        if speculative_fix_task is not None:
+            speculative_fix_task.cancel()
 
     # This should never be reached, but adding as safety net
-    print("🔄 Generating fallback response as safety net...")
-    return generate_fallback_response(question)
+    logger.info("🔄 Generating fallback response as safety net...")
+    return await generate_fallback_response(question)
+
+# --- 4. In-Flight Request Deduplication and Admission Control ---
+_inflight_requests: Dict[str, asyncio.Future] = {}
+
+# Bursts queue here instead of all hitting Docker and the LLM API at once
+_pipeline_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PIPELINES)
+_queued_pipelines = 0
+
+def pipeline_queue_full() -> bool:
+    """True when every pipeline slot is taken and the wait queue is at its limit."""
+    return _pipeline_semaphore.locked() and _queued_pipelines >= MAX_QUEUED_PIPELINES
+
+@asynccontextmanager
+async def pipeline_slot():
+    """Hold one of the MAX_CONCURRENT_PIPELINES slots, counting the wait towards the queue limit."""
+    global _queued_pipelines
+    _queued_pipelines += 1
+    try:
+        await _pipeline_semaphore.acquire()
+    finally:
+        _queued_pipelines -= 1
+    try:
+        yield
+    finally:
+        _pipeline_semaphore.release()
+
+async def run_admitted_pipeline(question: str, files: Dict[str, str], data_dir: str, request_key: str, data_hash: str) -> Any:
+    """Run the pipeline once one of the MAX_CONCURRENT_PIPELINES slots is free."""
+    async with pipeline_slot():
+        return await run_analysis_pipeline(question, files, data_dir, request_key, data_hash)
+
+async def run_batch_pipeline(questions: List[str], files: Dict[str, str], data_dir: str) -> List[str]:
+    """Answer several questions about the same files: Stages 1-2 run once, Stages 3-4 per question in parallel."""
+    data_hash = await asyncio.to_thread(compute_data_hash, files)
+    execution_data_hash = data_hash if files else None
+    # One strategist/acquisition pass that has to cover every question's data needs
+    combined_question = "\n".join(f"{i}. {q}" for i, q in enumerate(questions, 1))
+    async with pipeline_slot():
+        shared_context = await prepare_analysis_context(
+            combined_question, files, data_dir, execution_data_hash, choose_plan_model(combined_question)
+        )
+    # A speculative plan would answer the combined question, not any single one
+    if shared_context["speculative_plan_task"] is not None:
+        shared_context["speculative_plan_task"].cancel()
+    shared_context["speculative_plan_task"] = None
+
+    async def answer_question(q: str) -> Any:
+        # Each question takes its own pipeline slot, so a batch stays within MAX_CONCURRENT_PIPELINES
+        async with pipeline_slot():
+            return await run_analysis_pipeline(q, files, data_dir, None, data_hash, shared_context)
+
+    logger.info("--- BATCH: Running Stages 3-4 for %s questions in parallel ---", len(questions))
+    results = await asyncio.gather(*(answer_question(q) for q in questions), return_exceptions=True)
+    # One failing question must not discard the others' answers
+    return [
+        orjson.dumps({"error": f"Analysis failed: {r}", "result": None}).decode() if isinstance(r, Exception) else r
+        for r in results
+    ]
+
+async def run_deduplicated_pipeline(question: str, files: Dict[str, str], data_dir: str) -> Any:
+    """Run the pipeline once per distinct request; identical concurrent requests share its result."""
+    # Hashing reads every uploaded byte, so it runs off the event loop
+    data_hash = await asyncio.to_thread(compute_data_hash, files)
+    request_key = compute_request_key(question, data_hash)
+    inflight = _inflight_requests.get(request_key)
+    if inflight is not None:
+        logger.info("🔁 Identical request already in progress. Waiting for its result...")
+        # shield() so a disconnecting duplicate does not cancel the shared run
+        try:
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # The shared run itself was cancelled (e.g. its own timeout), not this waiter
+            raise RuntimeError("The identical in-flight request was cancelled.")
+
+    inflight = asyncio.get_running_loop().create_future()
+    _inflight_requests[request_key] = inflight
+    try:
+        result = await run_admitted_pipeline(question, files, data_dir, request_key, data_hash)
+        inflight.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        inflight.cancel()
+        raise
+    except Exception as e:
+        inflight.set_exception(e)
+        inflight.exception()  # Mark as retrieved so it is not logged when nobody else was waiting
+        raise
+    finally:
+        del _inflight_requests[request_key]
+
+def direct_response(question: str, files: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Immediate answer for probes and questions no pipeline can answer, or None to run the pipeline."""
+    if _PROBE_QUESTION_RE.match(question):
+        return {"status": "ok"}
+    if len(question.strip()) < MIN_QUESTION_LENGTH:
+        return {"error": "The question is empty or too short to analyze.", "result": None}
+    # A question with a URL fetches its data from the web, whatever it calls that data
+    if not files and _UPLOAD_REFERENCE_RE.search(question) and not _URL_RE.search(question):
+        return {"error": "The question refers to uploaded data, but no data files were received.", "result": None}
+    return None
+
+def parse_batch_questions(questions_json: bytes) -> List[str]:
+    """The questions of a questions.json upload, which must be a non-empty list of non-empty strings."""
+    try:
+        questions = orjson.loads(questions_json)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="questions.json is not valid JSON.")
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) and q.strip() for q in questions):
+        raise HTTPException(status_code=400, detail="questions.json must be a non-empty list of question strings.")
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"questions.json may list at most {MAX_BATCH_QUESTIONS} questions.")
+    return questions
+
+def parse_pipeline_result(result_str: str) -> Any:
+    """Parse the script output as JSON, otherwise return it as a string wrapped in JSON."""
+    try:
+        return orjson.loads(result_str)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        # pandas output often contains NaN/Infinity, which only the stdlib parser accepts;
+        # they become null because the response itself must be strict JSON
+        return json.loads(result_str, parse_constant=lambda constant: None)
+    except json.JSONDecodeError:
+        return {"result": result_str}
 
 # --- 5. API Server Definition ---
 app = FastAPI(title="Data Analyst Agent API")
 
+@app.on_event("startup")
+async def startup_thread_pool():
+    """Bound the executor behind asyncio.to_thread and aiofiles, shared by all requests of this worker."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="blocking-io")
+    )
+
+@app.on_event("startup")
+def startup_docker_sandbox():
+    """Warm up the sandbox container pool before the first request arrives."""
+    sandbox_pool.start()
+
+@app.on_event("shutdown")
+def shutdown_docker_sandbox():
+    """Tear down every sandbox container in the pool."""
+    sandbox_pool.shutdown()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the Claude response cache since startup, plus its current size."""
+    return {**claude_cache_stats, "entries": len(claude_response_cache)}
+
+async def receive_uploads(request: Request, upload_dir: str) -> Tuple[Dict[str, bytes], Dict[str, str]]:
+    """Stream the multipart body, writing data files to disk while later parts are still arriving.
+
+    Returns the contents of the request files (REQUEST_FILENAMES) and the paths of the data files.
+    """
+    _, content_type_options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = content_type_options.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data request.")
+
+    # The parser's callbacks are synchronous, so they only record events; the disk writes happen below
+    events: List[Tuple[str, bytes]] = []
+    header_field, header_value = bytearray(), bytearray()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        if header_field.lower() == b"content-disposition":
+            events.append(("disposition", bytes(header_value)))
+        header_field.clear()
+        header_value.clear()
+
+    parser = MultipartParser(boundary, callbacks={
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", b"")),
+    })
+
+    request_files: Dict[str, bytes] = {}
+    data_files: Dict[str, str] = {}
+    filename, buffer, out_file = None, bytearray(), None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event, data in events:
+                if event == "disposition":
+                    _, disposition_options = parse_options_header(data)
+                    # Fields without a filename are plain form values, which the API does not use
+                    filename = disposition_options.get(b"filename", b"").decode() or None
+                    if filename:
+                        # Only the final path component is kept, so no part is written outside upload_dir
+                        filename = os.path.basename(filename.replace("\\", "/"))
+                        if filename in ("", ".", ".."):
+                            raise HTTPException(status_code=400, detail="Uploaded file has an invalid filename.")
+                    if filename and filename not in REQUEST_FILENAMES:
+                        data_files[filename] = os.path.join(upload_dir, filename)
+                        out_file = await aiofiles.open(data_files[filename], 'wb')
+                elif event == "data" and filename:
+                    buffer.extend(data)
+                    if out_file is not None and len(buffer) >= UPLOAD_CHUNK_BYTES:
+                        await out_file.write(buffer)
+                        buffer.clear()
+                elif event == "end" and filename:
+                    if out_file is None:
+                        request_files[filename] = bytes(buffer)
+                        logger.debug("✔️ Request File '%s' received.", filename)
+                    else:
+                        await out_file.write(buffer)
+                        await out_file.close()
+                        out_file = None
+                        logger.debug("✔️ Additional file '%s' written to disk.", filename)
+                        # The sandbox warms up while the remaining parts are still uploading
+                        if len(data_files) == 1:
+                            spawn_background_task(prewarm_docker_sandbox())
+                    filename = None
+                    buffer.clear()
+            events.clear()
+        parser.finalize()
+    finally:
+        if out_file is not None:
+            await out_file.close()
+    return request_files, data_files
+
 @app.post("/api/")
 async def analyze_data(request: Request):
     """Accepts a task description and files with flexible naming, then performs analysis."""
-    print("\n\n--- [START] New Request Received ---")
+    logger.info("--- [START] New Request Received ---")
     
+    if pipeline_queue_full():
+        logger.warning("🚦 Too many analyses queued, rejecting request.")
+        raise HTTPException(status_code=429, detail="Too many analyses in progress. Please retry shortly.")
+
     questions_content = None
+    batch_questions = None
     
     try:
-        # Parse the multipart form data
-        form = await request.form()
-        
-        # Find the questions.txt file
-        other_files = {}
-        
-        for field_name, file_data in form.items():
-            if hasattr(file_data, 'filename') and hasattr(file_data, 'read'):
-                # This is a file upload
-                filename = file_data.filename
-                file_content = await file_data.read()
-                
-                if filename == "question.txt":
-                    questions_content = file_content.decode('utf-8')
-                    print(f"✔️ Main Request File '{filename}' processed.")
-                else:
-                    other_files[filename] = file_content
-                    print(f"✔️ Additional file '{filename}' processed.")
-        
-        # Validate that questions.txt was provided
-        if questions_content is None:
-            # Generate fallback response even for missing question file
-            fallback_response = generate_fallback_response("No question provided")
-            return json.loads(fallback_response)
-        
-        print(f"Question Content:\n{questions_content}")
-        
-        if other_files:
-            print(f"✔️ {len(other_files)} additional file(s) processed: {list(other_files.keys())}")
-
-        # Create temporary directory and write files
-        with tempfile.TemporaryDirectory() as tmpdir:
-            for name, content in other_files.items():
-                full_path = os.path.join(tmpdir, name)
-                with open(full_path, 'wb') as f:
-                    f.write(content)
+        # Create temporary directory; uploads are streamed straight into it
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
+            # Data files are on disk once this returns; the question files stay in memory
+            request_files, other_files = await receive_uploads(request, tmpdir)
+            if "question.txt" in request_files and "questions.json" in request_files:
+                raise HTTPException(status_code=400, detail="Upload either question.txt or questions.json, not both.")
+            if "question.txt" in request_files:
+                questions_content = request_files["question.txt"].decode('utf-8')
+            if "questions.json" in request_files:
+                batch_questions = parse_batch_questions(request_files["questions.json"])
+                logger.debug("✔️ Batch of %s question(s) received.", len(batch_questions))
+            
+            # A questions.json batch shares data loading across all of its questions
+            if batch_questions:
+                questions_content = "\n".join(f"{i}. {q}" for i, q in enumerate(batch_questions, 1))
+                logger.debug("Batch Questions:\n%s", questions_content)
+                results = await run_with_timeout(
+                    run_batch_pipeline(batch_questions, other_files, tmpdir),
+                    MAX_PIPELINE_TIMEOUT,
+                    questions_content
+                )
+                logger.info("--- [END] Sending Batch Response ---")
+                # On timeout this is the single fallback answer rather than a list
+                if isinstance(results, str):
+                    return parse_pipeline_result(results)
+                return [parse_pipeline_result(result_str) for result_str in results]
+
+            # Validate that questions.txt was provided
+            if questions_content is None:
+                # Generate fallback response even for missing question file
+                fallback_response = await generate_fallback_response("No question provided")
+                return orjson.loads(fallback_response)
+            
+            logger.debug("Question Content:\n%s", questions_content)
+            
+            if other_files:
+                logger.debug("✔️ %s additional file(s) processed: %s", len(other_files), list(other_files.keys()))
            
-            print(f"✔️ Data files temporarily written to: {tmpdir}")
-
-            # Run the analysis pipeline
-            result_str = await run_analysis_pipeline(questions_content, other_files, tmpdir)
+            logger.debug("✔️ Data files temporarily written to: %s", tmpdir)
+
+            # Probes and unanswerable questions skip the LLM and the sandbox entirely
+            immediate = direct_response(questions_content, other_files)
+            if immediate is not None:
+                logger.info("⚡ Answered directly without running the pipeline: %s", immediate)
+                return immediate
+
+            # Run the analysis pipeline within the overall time budget
+            result_str = await run_with_timeout(
+                run_deduplicated_pipeline(questions_content, other_files, tmpdir),
+                MAX_PIPELINE_TIMEOUT,
+                questions_content
+            )
        
-        print("✅ Analysis finished successfully.")
-        print("--- [END] Sending Final Response ---")
+        logger.info("✅ Analysis finished successfully.")
+        logger.info("--- [END] Sending Final Response ---")
         
-        # Try to parse as JSON, otherwise return as string wrapped in JSON
-        try:
-            return json.loads(result_str)
-        except json.JSONDecodeError:
-            return {"result": result_str}
+        return parse_pipeline_result(result_str)
 
     except HTTPException:
         # Re-raise HTTP exceptions as-is
         raise
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"❌ An error occurred during the request:\n{error_trace}")
-        print("--- [END] Generating Fallback Response Due to Server Error ---")
+        logger.error("❌ An error occurred during the request: %s", e)
+        logger.debug("Request failure traceback:", exc_info=True)
+        logger.info("--- [END] Generating Fallback Response Due to Server Error ---")
         
         # Generate fallback response for any server-level errors
         fallback_question = questions_content if questions_content else "Server error occurred"
-        fallback_response = generate_fallback_response(fallback_question)
+        fallback_response = await generate_fallback_response(fallback_question)
         
         try:
-            return json.loads(fallback_response)
-        except json.JSONDecodeError:
+            return orjson.loads(fallback_response)
+        except orjson.JSONDecodeError:
             # Last resort - return basic error structure
             return {"error": "Server error occurred", "result": "Analysis could not be completed"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker runs its own event loop, sandbox pool and concurrency limits, so these multiply
+    # with the worker count; the on-disk Claude cache is shared
+    workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=workers)